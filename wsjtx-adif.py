@@ -37,11 +37,17 @@ either expressed or implied, of the project.
 
 """
 
+import bisect
 import datetime
+import os
+import stat
 import sys
 import re
-import pytz
 import argparse
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from itertools import repeat
+from zoneinfo import ZoneInfo
 
 # adif band identifiers and rough band edges
 BAND_FREQ = {
@@ -60,35 +66,48 @@ BAND_FREQ = {
     '70cm': (430000, 440000),
 }
 
+# bands as (low, high, band) sorted by lower edge, for bisecting
+BANDS_SORTED = sorted((lo, hi, band) for band, (lo, hi) in BAND_FREQ.items())
+BAND_LOS = [b[0] for b in BANDS_SORTED]
+
+# number of ADIF rows to collect before writing them out in one go
+OUT_BUF_ROWS = 256
+
+# regular expression for validating a 4-character locator
+RE_LOC = re.compile(r'^[A-Z][A-Z][0-9][0-9]$')
+
+@lru_cache(maxsize=64)
 def freq_to_band(freq_khz):
     """
     Convert frequency, in kilohertz, to an adif band identifier
     """
-    for band in BAND_FREQ:
-        if BAND_FREQ[band][0] <= freq_khz and BAND_FREQ[band][1] >= freq_khz:
-            return band
-            
+    i = bisect.bisect_right(BAND_LOS, freq_khz) - 1
+    if i >= 0 and BANDS_SORTED[i][1] >= freq_khz:
+        return BANDS_SORTED[i][2]
+    
     return None
 
+@lru_cache(maxsize=64)
+def parse_freq(s_freq_mhz):
+    "Parse a log frequency string, in megahertz, to an adif band and freq"
+    f = float(s_freq_mhz)
+    return freq_to_band(f*1000.0), '%.3f' % f
+
 def adif_date(dt):
     "Datetime object to ADIF date, requires an UTC datetime object"
-    return dt.strftime("%Y%m%d")
+    return f'{dt.year:04d}{dt.month:02d}{dt.day:02d}'
 
 def adif_time(dt):
     "Datetime object to ADIF time, requires an UTC datetime object"
-    return dt.strftime("%H%M%S")
+    return f'{dt.hour:02d}{dt.minute:02d}{dt.second:02d}'
 
-def adif_db(d):
-    "Signal report in dB, ADIF formatted"
-    v = int(d)
-    if v >= 0:
-        return '+%02d' % v
-    else:
-        return '-%02d' % (v * -1)
+def adif_db(v):
+    "Signal report in dB, from an integer, ADIF formatted"
+    return f'{v:+03d}'
 
 def adif_field(k, v):
     "ADIF field key-length-value encoding"
-    if v == None:
+    if v is None:
         return ''
         
     return '<%s:%d>%s' % (k, len(v), v)
@@ -97,125 +116,339 @@ def adif_row(h):
     "ADIF row encoding from a dictionary"
     return ' '.join([adif_field(k, h[k]) for k in h]) + ' <eor>\n'
 
-
-def convert(args):
-    "Convert a file"
+def format_qso_row(o):
+    """
+    ADIF row encoding for a logged QSO dictionary, as built by parse_qsos().
+    Like adif_row(), but with the fixed fields formatted directly, and an
+    unknown band left out instead of leaving an empty field in the row.
+    """
+    call = o['call']
+    mode = o['mode']
+    rst_sent = o['rst_sent']
+    rst_rcvd = o['rst_rcvd']
+    qso_date = o['qso_date']
+    time_on = o['time_on']
+    qso_date_off = o['qso_date_off']
+    time_off = o['time_off']
+    freq = o['freq']
+    station_callsign = o['station_callsign']
     
-    # Local timezone (or possibly UTC) in wsjtx log file, for converting to UTC in ADIF
-    tz_local = pytz.timezone(args.tz)
+    parts = [
+        f'<call:{len(call)}>{call}',
+        f'<mode:{len(mode)}>{mode}',
+        f'<rst_sent:{len(rst_sent)}>{rst_sent}',
+        f'<rst_rcvd:{len(rst_rcvd)}>{rst_rcvd}',
+        f'<qso_date:{len(qso_date)}>{qso_date}',
+        f'<time_on:{len(time_on)}>{time_on}',
+        f'<qso_date_off:{len(qso_date_off)}>{qso_date_off}',
+        f'<time_off:{len(time_off)}>{time_off}',
+    ]
     
-    # parse from either stdin (default), or from a given input file
-    if args.infile:
-        inf = open(args.infile, 'r')
-    else:
-        inf = sys.stdin
-        
-    # write either to stdout (default), or to a given output file
-    if args.outfile:
-        outf = open(args.outfile, 'w')
-    else:
-        outf = sys.stdout
+    # band is unknown for frequencies outside BAND_FREQ
+    band = o['band']
+    if band is not None:
+        parts.append(f'<band:{len(band)}>{band}')
     
-    outf.write("wsjtx fox ADIF Export<eoh>\n")
-
-    # regular expressions needed to parse entries
-    # 2019-11-22 05:25:37  21.091  1  0  0 Sel:  JM1LSQ      -17 QM05
-    # 2019-11-22 05:26:00  21.091  0  1  1 Tx1:  JM1LSQ XZ2D -17
-    # 2019-11-22 05:26:29  21.091  0  1  1 Rx:   052615  -8 -0.0  300 ~  XZ2D JM1LSQ R+01
-    # 2019-11-22 05:26:30  21.091  0  1  1 Log:  JM1LSQ QM05 -17 +01 15m
-
-    re_line = re.compile('^(\d{4}-\d{2}-\d{2}) (\d{2}:\d{2}:\d{2})\s+(\d+\.\d+)\s+\d+\s+\d+\s+\d+\s+(\w+:)\s+(.*)')
-    re_loc = re.compile('^[A-Z][A-Z][0-9][0-9]$')
+    parts.append(f'<freq:{len(freq)}>{freq}')
+    parts.append(f'<station_callsign:{len(station_callsign)}>{station_callsign}')
+    
+    gridsquare = o.get('gridsquare')
+    if gridsquare is not None:
+        parts.append(f'<gridsquare:{len(gridsquare)}>{gridsquare}')
+    
+    tx_pwr = o.get('tx_pwr')
+    if tx_pwr is not None:
+        parts.append(f'<tx_pwr:{len(tx_pwr)}>{tx_pwr}')
+    
+    return ' '.join(parts) + ' <eor>\n'
 
-    locs = {}  
-    ongoing = {}
-    logged = {}
 
-    for l in inf:
-        g = re_line.match(l)
-        if not g:
-            #print("no match: %s" % l)
+def parse_qsos(lines, tz_local, mycall, power=None, ongoing=None, selected=None, unmatched=None):
+    """
+    Parse wsjt-x log lines, generating an ADIF row for each QSO found.
+    Timestamps are converted from tz_local to UTC.
+    
+    When parsing a chunk of a log, ongoing QSOs are left in the ongoing
+    dictionary, calls selected are added to the selected set, and R reports
+    from calls not selected within the chunk are appended to unmatched,
+    so that QSOs spanning chunks can be completed by the caller.
+    selected and unmatched are only tracked when both are given, as
+    parse_chunk() does.
+    """
+    
+    # UTC offsets of tz_local, cached by local date and hour
+    utc_offsets = {}
+    if ongoing is None:
+        ongoing = {}
+    
+    for l in lines:
+        # only Sel: and Rx: lines are acted upon; skip the rest before
+        # splitting them up
+        if 'Sel:' not in l and 'Rx:' not in l:
             continue
         
-        s_date = g.group(1)
-        s_time = g.group(2)
-        s_freq_mhz = g.group(3)
-        s_linetype = g.group(4)
-        s_string = g.group(5)
+        # log lines are whitespace-separated columns:
+        # 2019-11-22 05:25:37  21.091  1  0  0 Sel:  JM1LSQ      -17 QM05
+        # 2019-11-22 05:26:00  21.091  0  1  1 Tx1:  JM1LSQ XZ2D -17
+        # 2019-11-22 05:26:29  21.091  0  1  1 Rx:   052615  -8 -0.0  300 ~  XZ2D JM1LSQ R+01
+        # 2019-11-22 05:26:30  21.091  0  1  1 Log:  JM1LSQ QM05 -17 +01 15m
+        parts = l.split(None, 7)
+        if len(parts) < 8:
+            #print("no match: %s" % l)
+            continue
         
-        # Parse timestamp to a datetime object, in log's local time
-        d_dt = datetime.datetime.strptime(s_date + ' ' + s_time, '%Y-%m-%d %H:%M:%S')
-        #print("date %s freq %s '%s' '%s'" % (d_dt, s_freq_mhz, s_linetype, s_string))
+        s_date, s_time, s_freq_mhz, _, _, _, s_linetype, s_string = parts
+        #print("date %s %s freq %s '%s' '%s'" % (s_date, s_time, s_freq_mhz, s_linetype, s_string))
         
         # a station was selected by the operator for working; mark QSO as initiated/replied
         if s_linetype == 'Sel:':
             call, s_db_sent, loc = s_string.split() 
+            try:
+                rst_sent = adif_db(int(s_db_sent))
+            except ValueError:
+                print("sel: Invalid report: %s" % l, file=sys.stderr)
+                continue
+            try:
+                band, freq = parse_freq(s_freq_mhz)
+            except ValueError:
+                print("sel: Invalid frequency: %s" % l, file=sys.stderr)
+                continue
+            
             ongoing[call] = {
-                'freq': s_freq_mhz,
+                'band': band,
+                'freq': freq,
                 'loc': loc,
-                's_db_sent': s_db_sent
+                'rst_sent': rst_sent
             }
+            if selected is not None:
+                selected.add(call)
         
         elif s_linetype == 'Rx:':
             # We received something
             
             a = s_string.split()
             if len(a) < 8:
-                print("rx: Not enough arguments: %s" % l)
+                print("rx: Not enough arguments: %s" % l, file=sys.stderr)
                 continue
             
             s_tm, db, foo1, foo2, foo3, my, call, report_rx = a
-            s_db_rx = report_rx[1:]
             
             # strip <OH0/OH7LZB> to OH0/OH7LZB
             if call.startswith('<') and call.endswith('>'):
                 call = call[1:-1]
             
-            # If this is an ongoing QSO that we selected, and the report is a R, log it
-            if call in ongoing and report_rx.startswith('R'):
-                # convert timestamp to UTC
-                d_dt_local = tz_local.localize(d_dt)
-                d_dt_utc = d_dt_local.astimezone(pytz.utc)
-                
-                q = ongoing[call]
-                o = {
-                    'call': call,
-                    'mode': 'FT8',
-                    'rst_sent': adif_db(q['s_db_sent']),
-                    'rst_rcvd': adif_db(s_db_rx),
-                    'qso_date': adif_date(d_dt_utc),
-                    'time_on': adif_time(d_dt_utc),
-                    'qso_date_off': adif_date(d_dt_utc),
-                    'time_off': adif_time(d_dt_utc),
-                    'band': freq_to_band(float(q['freq'])*1000.0),
-                    'freq': '%.3f' % (float(q['freq'])),
-                    'station_callsign': args.mycall,
-                }
-                
-                # locator is optional; OH0/OH7LZB calls do not transmit it
-                if re_loc.match(q['loc']):
-                    o['gridsquare'] = q['loc']
-                
-                # optionally log our tx power
-                if args.power:
-                    o['tx_pwr'] = '%d' % args.power
-                
-                # log it out, forget the ongoing QSO to prevent double logging
-                outf.write(adif_row(o))
-                del ongoing[call]
+            # Only a R+report completes a QSO; RRR and RR73 do not carry one
+            if report_rx[:1] != 'R':
+                continue
+            try:
+                rx_db = int(report_rx[1:])
+            except ValueError:
+                continue
             
+            # If this is an ongoing QSO that we selected, log it; forget the
+            # ongoing QSO to prevent double logging
+            q = ongoing.pop(call, None)
+            if q is None:
+                # the call may have been selected before this chunk
+                if selected is not None and unmatched is not None and call not in selected:
+                    unmatched.append(l)
+                continue
+            
+            # Parse timestamp to a datetime object, in log's local time;
+            # this also validates the date and time columns
+            try:
+                d_dt = datetime.datetime.fromisoformat(s_date + 'T' + s_time)
+            except ValueError:
+                print("rx: Invalid timestamp: %s" % l, file=sys.stderr)
+                # keep the QSO ongoing for a later valid R report
+                ongoing[call] = q
+                continue
             
-parser = argparse.ArgumentParser(description='Convert wsjt-x fox mode log file to ADIF')
-parser.add_argument('--mycall', metavar='N0CALL', type=str, required=True,
-                    help='My callsign')
-parser.add_argument('--tz', metavar='Europe/Helsinki', type=str, default='UTC',
-                    help='Timezone in log file, defaults to UTC; timestamps will be converted from this timezone to UTC for ADIF')
-parser.add_argument('--in', metavar='infile', dest='infile', type=str,
-                    help='Input file: wsjt-x .txt log file, defaults to STDIN')
-parser.add_argument('--out', metavar='outfile', dest='outfile', type=str,
-                    help='Output file: ADIF file, defaults to STDOUT')
-parser.add_argument('--power', dest='power', metavar='100', type=int,
-                    help='My transmitter power, in watts, for log rows')
-
-args = parser.parse_args()
-convert(args)
+            # convert timestamp to UTC; the offset only changes at DST
+            # transitions, so look it up once per hour of local time
+            offset_key = s_date + s_time[:2]
+            offset = utc_offsets.get(offset_key)
+            if offset is None:
+                d_dt_local = d_dt.replace(tzinfo=tz_local)
+                # in the hour repeated at the end of DST, take standard time
+                # like pytz's localize() did, not the earlier DST offset
+                if d_dt_local.dst():
+                    d_dt_local = d_dt_local.replace(fold=1)
+                offset = d_dt_local.utcoffset()
+                utc_offsets[offset_key] = offset
+            d_dt_utc = d_dt - offset
+            qso_date = adif_date(d_dt_utc)
+            qso_time = adif_time(d_dt_utc)
+            
+            o = {
+                'call': call,
+                'mode': 'FT8',
+                'rst_sent': q['rst_sent'],
+                'rst_rcvd': adif_db(rx_db),
+                'qso_date': qso_date,
+                'time_on': qso_time,
+                'qso_date_off': qso_date,
+                'time_off': qso_time,
+                'band': q['band'],
+                'freq': q['freq'],
+                'station_callsign': mycall,
+            }
+            
+            # locator is optional; OH0/OH7LZB calls do not transmit it
+            if RE_LOC.match(q['loc']):
+                o['gridsquare'] = q['loc']
+            
+            # optionally log our tx power
+            if power:
+                o['tx_pwr'] = '%d' % power
+            
+            # log it out
+            yield format_qso_row(o)
+
+def parse_chunk(data, tz, mycall, power):
+    """
+    Parse a chunk of a log in a worker process. Returns the ADIF output
+    as segments split at each unmatched R report, the unmatched report
+    lines, the QSOs left ongoing, and the calls selected in the chunk.
+    """
+    
+    ongoing = {}
+    selected = set()
+    unmatched = []
+    rows = []
+    # number of rows logged before each unmatched report
+    cuts = []
+    
+    for row in parse_qsos(data.splitlines(), ZoneInfo(tz), mycall, power,
+                          ongoing, selected, unmatched):
+        cuts.extend([len(rows)] * (len(unmatched) - len(cuts)))
+        rows.append(row)
+    cuts.extend([len(rows)] * (len(unmatched) - len(cuts)))
+    
+    segments = [''.join(rows[a:b]) for a, b in zip([0] + cuts, cuts + [len(rows)])]
+    
+    return segments, unmatched, ongoing, selected
+
+def split_chunks(data, n):
+    """
+    Split log text to about n chunks, each starting at a Sel: line
+    """
+    
+    chunks = []
+    start = 0
+    chunk_len = len(data) // n + 1
+    
+    while start < len(data):
+        # cut at the start of the first Sel: line after the target length
+        i = data.find('Sel:', start + chunk_len)
+        if i < 0:
+            break
+        cut = data.rfind('\n', start, i) + 1
+        if cut <= start:
+            cut = data.find('\n', i) + 1
+            if cut <= 0:
+                break
+        chunks.append(data[start:cut])
+        start = cut
+    
+    if start < len(data):
+        chunks.append(data[start:])
+    
+    return chunks
+
+def convert_parallel(data, outf, args):
+    """
+    Convert log text in args.jobs worker processes, writing ADIF rows to outf
+    """
+    
+    tz_local = ZoneInfo(args.tz)
+    # a few chunks per worker evens out differences in chunk parsing time
+    chunks = split_chunks(data, args.jobs * 4)
+    # QSOs ongoing at the end of the chunks parsed so far
+    ongoing = {}
+    
+    with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        results = executor.map(parse_chunk, chunks, repeat(args.tz),
+                               repeat(args.mycall), repeat(args.power))
+        for segments, unmatched, chunk_ongoing, selected in results:
+            # complete QSOs selected in earlier chunks, in log order
+            outf.write(segments[0])
+            for l, segment in zip(unmatched, segments[1:]):
+                for row in parse_qsos([l], tz_local, args.mycall, args.power, ongoing):
+                    outf.write(row)
+                outf.write(segment)
+            
+            # a selection within the chunk replaces an earlier one
+            for call in selected:
+                ongoing.pop(call, None)
+            ongoing.update(chunk_ongoing)
+    
+    outf.flush()
+
+
+def convert(args):
+    "Convert a file"
+    
+    # Local timezone (or possibly UTC) in wsjtx log file, for converting to UTC in ADIF
+    tz_local = ZoneInfo(args.tz)
+    
+    # parse from either stdin (default), or from a given input file
+    if args.infile:
+        inf = open(args.infile, 'r')
+    else:
+        inf = sys.stdin
+    
+    # write either to stdout (default), or to a given output file
+    if args.outfile:
+        outf = open(args.outfile, 'w')
+    else:
+        outf = sys.stdout
+    
+    outf.write("wsjtx fox ADIF Export<eoh>\n")
+    
+    # split the log to chunks at Sel: lines and parse them in worker processes
+    if args.jobs > 1:
+        convert_parallel(inf.read(), outf, args)
+        return
+    
+    # wsjt-x logs are small, so read a regular file in at once; a pipe or
+    # terminal of unknown size is iterated line by line
+    if stat.S_ISREG(os.fstat(inf.fileno()).st_mode):
+        lines = inf.read().splitlines()
+    else:
+        lines = inf
+    
+    # ADIF rows waiting to be written out
+    out_buf = []
+    
+    for row in parse_qsos(lines, tz_local, args.mycall, args.power):
+        out_buf.append(row)
+        if len(out_buf) >= OUT_BUF_ROWS:
+            outf.write(''.join(out_buf))
+            out_buf.clear()
+    
+    # write out the remaining rows
+    outf.write(''.join(out_buf))
+    outf.flush()
+            
+            
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert wsjt-x fox mode log file to ADIF')
+    parser.add_argument('--mycall', metavar='N0CALL', type=str, required=True,
+                        help='My callsign')
+    parser.add_argument('--tz', metavar='Europe/Helsinki', type=str, default='UTC',
+                        help='Timezone in log file, defaults to UTC; timestamps will be converted from this timezone to UTC for ADIF')
+    parser.add_argument('--in', metavar='infile', dest='infile', type=str,
+                        help='Input file: wsjt-x .txt log file, defaults to STDIN')
+    parser.add_argument('--out', metavar='outfile', dest='outfile', type=str,
+                        help='Output file: ADIF file, defaults to STDOUT')
+    parser.add_argument('--power', dest='power', metavar='100', type=int,
+                        help='My transmitter power, in watts, for log rows')
+    parser.add_argument('--jobs', dest='jobs', metavar='N', type=int, default=1,
+                        help='Number of worker processes for parsing large logs, defaults to 1')
+    
+    args = parser.parse_args()
+    if args.jobs < 1:
+        parser.error('--jobs must be at least 1')
+    
+    convert(args)